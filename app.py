@@ -2,20 +2,52 @@ import streamlit as st
 import fitz  # PyMuPDF
 import cloudinary
 import cloudinary.uploader
+import cloudinary.api
+import cloudinary.exceptions
 import io  
+import sys
+import gc
+import hashlib
+import time
+import concurrent.futures
+from functools import lru_cache
+import numpy as np
+from PIL import Image
+
+# --- Upload Settings ---
+
+LARGE_UPLOAD_THRESHOLD = 10_000_000  # bytes; bigger files use chunked upload
+UPLOAD_CHUNK_SIZE = 6 * 1024 * 1024
+UPLOAD_ATTEMPTS = 3
+
+# --- Preview Settings ---
+
+PREVIEW_WIDTH = 600  # px; about half a desktop screen, the preview column's width
+PREVIEW_JPEG_QUALITY = 75
+
+# --- Processing Settings ---
+
+QUICK_PAGES = 50  # pages in the early download offered for very long PDFs
+# Coloring + saving costs roughly 0.7-1.3 ms per page (measured on synthetic
+# text PDFs; image size barely matters), so below this a full run finishes
+# in a few seconds and an early copy isn't worth it
+QUICK_COPY_MIN_PAGES = 5000
 
 # --- Helper Functions ---
 
+@lru_cache(maxsize=128)
 def hex_to_rgb(hex_color):
     """
     Converts hex color ('#RRGGBB') to a tuple (r, g, b) with values 0-1.
     """
-    hex_color = hex_color.lstrip('#')
-    return tuple(int(hex_color[i:i+2], 16) / 255.0 for i in (0, 2, 4))
+    b = bytes.fromhex(hex_color.lstrip('#'))
+    return (b[0] / 255.0, b[1] / 255.0, b[2] / 255.0)
 
-def upload_to_cloudinary(file_bytes, file_name):
+@st.cache_resource(show_spinner=False)
+def _init_cloudinary():
     """
-    Uploads the file to Cloudinary securely.
+    Configures the Cloudinary SDK once per server process.
+    Returns False when no Cloudinary secrets are set.
     """
     # 1. Check if secrets exist
     if "cloudinary" in st.secrets:
@@ -27,48 +59,221 @@ def upload_to_cloudinary(file_bytes, file_name):
             api_key = secret["api_key"],
             api_secret = secret["api_secret"]
         )
+        return True
+    return False
+
+def _is_transient_upload_error(error):
+    """
+    Tells whether a failed upload is worth retrying: server errors, rate
+    limits and connection failures (which the SDK raises as a bare Error).
+    """
+    return type(error) is cloudinary.exceptions.Error or isinstance(
+        error, (cloudinary.exceptions.GeneralError, cloudinary.exceptions.RateLimited)
+    )
+
+def upload_to_cloudinary(file_bytes, file_name, content_id):
+    """
+    Uploads the file to Cloudinary securely.
+    content_id is a hex digest of file_bytes, used to make the asset ID unique.
+    """
+    try:
+        if not _init_cloudinary():
+            return None
+        
+        # Fix Filename & make the ID content-addressed
+        safe_name = file_name.replace(" ", "_").replace(".pdf", "")
+        public_id = f"{safe_name}_{content_id}"
         
+        # Same bytes already backed up? Reuse that asset. The lookup needs a
+        # concrete type: with resource_type="auto" Cloudinary always files
+        # PDFs (the only uploads this app accepts) as "image" assets.
+        # Any failure here (not found, rate limit, upload-only key, network)
+        # just falls through to a normal upload.
         try:
-            # Fix Filename & Stream
-            safe_name = file_name.replace(" ", "_").replace(".pdf", "")
+            return cloudinary.api.resource(public_id, resource_type="image").get("secure_url")
+        except cloudinary.exceptions.Error:
+            pass
+        
+        # Upload command (retried with exponential backoff)
+        for attempt in range(UPLOAD_ATTEMPTS):
+            # Fresh stream per attempt: upload_large closes the one it is given
             file_stream = io.BytesIO(file_bytes)
-            
-            # Upload command
-            response = cloudinary.uploader.upload(file_stream, resource_type="auto", public_id=safe_name)
-            
-            # Return URL
-            return response.get("secure_url")
-            
-        except Exception as e:
-            # Fail silently (don't show error to user if backup fails)
-            print(f"Backup Error: {e}")
-            return None
-    else:
+            try:
+                if len(file_bytes) > LARGE_UPLOAD_THRESHOLD:
+                    # Large files go up in chunks instead of one big request
+                    response = cloudinary.uploader.upload_large(
+                        file_stream,
+                        chunk_size=UPLOAD_CHUNK_SIZE,
+                        public_id=public_id,
+                        resource_type="auto",
+                        use_filename=False,
+                        unique_filename=False
+                    )
+                else:
+                    response = cloudinary.uploader.upload(file_stream, resource_type="auto", public_id=public_id)
+                break
+            except cloudinary.exceptions.Error as e:
+                if attempt == UPLOAD_ATTEMPTS - 1 or not _is_transient_upload_error(e):
+                    raise
+                time.sleep(2 ** attempt)
+        
+        # Return URL
+        return response.get("secure_url")
+        
+    except Exception as e:
+        # Fail silently (don't show error to user if backup fails)
+        print(f"Backup Error: {e}")
         return None
 
-def change_pdf_background(file_bytes, color_hex, intensity=0.3, is_overlay=False):
+def _release_doc(doc):
     """
-    Core Logic: Changes the background of the PDF.
+    Closes a document and trims MuPDF's global store so memory doesn't
+    creep up across Streamlit reruns. Collected MuPDF warnings go to stderr.
     """
-    doc = fitz.open(stream=file_bytes, filetype="pdf")
-    rgb_color = hex_to_rgb(color_hex)
+    doc.close()
+    fitz.TOOLS.store_shrink(100)
+    gc.collect()
+    
+    warnings = fitz.TOOLS.mupdf_warnings()
+    if warnings:
+        print(f"MuPDF warnings:\n{warnings}", file=sys.stderr)
 
-    for page in doc:
-        rect = page.rect
-        shape = page.new_shape()
-        
+def _apply_background(doc, rgb_color, intensity, is_overlay, start=0, stop=None, fill_xrefs=None):
+    """
+    Fills pages start..stop (default: all) of an open document with the
+    background (or tint) color.
+    The fill operators live in one content stream per page size, which every
+    page of that size references from its /Contents array. Pass the same
+    fill_xrefs dict to several calls on one document to reuse those streams.
+    """
+    # Pages are handled serially on purpose: PyMuPDF is not thread-safe and
+    # holds the GIL, so a thread pool over pages can crash and won't speed up.
+    r, g, b = rgb_color
+    if fill_xrefs is None:
+        fill_xrefs = {}  # page box -> shared fill stream (pages usually share one size)
+
+    for page in doc.pages(start, stop):
+        if is_overlay:
+            # Balance the existing graphics state before drawing on top of it
+            page.wrap_contents()
+            gstate = page._set_opacity(CA=intensity, ca=intensity)
+
+        box = tuple(page.mediabox)
+        if box not in fill_xrefs:
+            x0, y0, x1, y1 = box
+            op = f"{r:.3f} {g:.3f} {b:.3f} rg {x0:g} {y0:g} {x1 - x0:g} {y1 - y0:g} re f Q\n"
+            op = f"q /{gstate} gs " + op if is_overlay else "q " + op
+            xref = doc.get_new_xref()
+            doc.update_object(xref, "<<>>")
+            doc.update_stream(xref, op.encode())
+            fill_xrefs[box] = xref
+
+        contents = page.get_contents()
         if is_overlay:
-            # Overlay Mode
-            shape.draw_rect(rect)
-            shape.finish(fill=rgb_color, fill_opacity=intensity, color=None) 
-            shape.commit(overlay=True)
+            # Overlay Mode: semi-transparent fill drawn after the page content
+            contents = contents + [fill_xrefs[box]]
         else:
-            # Standard Mode
-            shape.draw_rect(rect)
-            shape.finish(fill=rgb_color, color=rgb_color)
-            shape.commit(overlay=False)
+            # Standard Mode: opaque fill drawn behind everything
+            contents = [fill_xrefs[box]] + contents
+        doc.xref_set_key(page.xref, "Contents", "[" + " ".join(f"{x} 0 R" for x in contents) + "]")
 
-    return doc
+def _save_pdf(doc):
+    """
+    Serializes a document to bytes.
+    """
+    # Only overlays were added, so skip garbage collection / cleaning passes
+    buf = io.BytesIO()
+    doc.save(buf, deflate=True, garbage=0, clean=False, incremental=False)
+    return buf.getvalue()
+
+def color_pdf(file_bytes, rgb_color, intensity=0.3, is_overlay=False, on_first_pages=None):
+    """
+    Colors the PDF and returns it as bytes (uncached, see change_pdf_background).
+    With on_first_pages set and a PDF longer than QUICK_PAGES, the first
+    QUICK_PAGES pages are colored first and passed to it as a separate,
+    shorter PDF before the rest of the document is done.
+    """
+    doc = fitz.open(stream=file_bytes, filetype="pdf")
+    try:
+        fill_xrefs = {}
+        start = 0
+        if on_first_pages is not None and doc.page_count > QUICK_PAGES:
+            _apply_background(doc, rgb_color, intensity, is_overlay, stop=QUICK_PAGES, fill_xrefs=fill_xrefs)
+            quick_doc = fitz.open()
+            try:
+                quick_doc.insert_pdf(doc, to_page=QUICK_PAGES - 1)
+                on_first_pages(_save_pdf(quick_doc))
+            finally:
+                quick_doc.close()
+            start = QUICK_PAGES
+
+        _apply_background(doc, rgb_color, intensity, is_overlay, start=start, fill_xrefs=fill_xrefs)
+        return _save_pdf(doc)
+    finally:
+        _release_doc(doc)
+
+class _CacheMiss(Exception):
+    """
+    Raised by change_pdf_background(_lookup_only=True) when nothing is cached.
+    """
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def change_pdf_background(file_bytes, rgb_color, intensity=0.3, is_overlay=False, _lookup_only=False, _result=None):
+    """
+    Core Logic: Changes the background of the PDF.
+    Returns the modified PDF as bytes (cached per file/settings).
+    _lookup_only raises _CacheMiss instead of processing, and _result stores
+    bytes that were colored elsewhere; neither is part of the cache key.
+    """
+    if _result is not None:
+        return _result
+    if _lookup_only:
+        raise _CacheMiss()
+    return color_pdf(file_bytes, rgb_color, intensity, is_overlay)
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def count_pages(file_bytes):
+    """
+    Returns the number of pages in the PDF.
+    """
+    doc = fitz.open(stream=file_bytes, filetype="pdf")
+    try:
+        return doc.page_count
+    finally:
+        _release_doc(doc)
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def render_preview_image(file_bytes, rgb_color, intensity=0.3, is_overlay=False, width=PREVIEW_WIDTH):
+    """
+    Renders the first page and tints it in pixel space, returning JPEG bytes.
+    The PDF itself is never modified for the preview.
+    """
+    preview_doc = fitz.open(stream=file_bytes, filetype="pdf")
+    try:
+        first_page = preview_doc.load_page(0)
+        # Render exactly as wide as it will be displayed, whatever the page size
+        zoom = width / first_page.rect.width
+        pix = first_page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False, colorspace=fitz.csRGB)
+        img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, 3)
+        del first_page, pix
+    finally:
+        _release_doc(preview_doc)
+
+    rgb_color_255 = np.rint(np.array(rgb_color, dtype=np.float32) * 255)
+
+    if is_overlay:
+        # Overlay Mode: alpha blend the tint over the whole page (float32 halves
+        # the temporary buffers compared to NumPy's default float64)
+        blended = img.astype(np.float32) * (1 - intensity) + rgb_color_255 * intensity
+        blended = blended.clip(0, 255).astype(np.uint8)
+    else:
+        # Standard Mode: replace the (near-)white background with the color
+        blended = img.copy()
+        blended[img.sum(axis=2, dtype=np.uint16) > 720] = rgb_color_255.astype(np.uint8)
+
+    buf = io.BytesIO()
+    Image.fromarray(blended).save(buf, "JPEG", quality=PREVIEW_JPEG_QUALITY)
+    return buf.getvalue()
 
 # --- Streamlit UI Code ---
 
@@ -88,38 +293,108 @@ col1, col2 = st.columns([1, 1])
 with col1:
     st.subheader("1. Upload & Settings")
     uploaded_file = st.file_uploader("Upload your PDF file", type="pdf")
+    # Read the upload once and share the bytes with both columns
+    file_bytes = uploaded_file.getvalue() if uploaded_file is not None else None
 
-    color_hex = st.color_picker("Pick a Background Color", "#FFFFCC") 
-    
-    is_overlay = st.checkbox("Enable Overlay Mode (For Scanned PDFs)", value=False)
-    
-    intensity = 0.3
-    if is_overlay:
-        st.info("ℹ️ Overlay mode adds a 'tint' on top of the page.")
-        intensity = st.slider("Tint Intensity", 0.1, 0.9, 0.3)
+    # Settings are batched in a form so tweaking them doesn't rerun the app
+    with st.form("pdf_settings"):
+        color_hex = st.color_picker("Pick a Background Color", "#FFFFCC") 
+        
+        is_overlay = st.checkbox("Enable Overlay Mode (For Scanned PDFs)", value=False)
+        
+        tint_intensity = st.slider(
+            "Tint Intensity", 0.1, 0.9, 0.3,
+            help="ℹ️ Overlay mode adds a 'tint' on top of the page. Only used in Overlay Mode."
+        )
 
-    process_btn = st.button("Process PDF", type="primary")
+        preview_col, process_col = st.columns(2)
+        with preview_col:
+            st.form_submit_button("Update Preview")
+        with process_col:
+            process_btn = st.form_submit_button("Process PDF", type="primary")
+
+    rgb_color = hex_to_rgb(color_hex)
+    intensity = tint_intensity if is_overlay else 0.3
 
     # --- MAIN LOGIC ---
     if process_btn and uploaded_file is not None:
-        # Read file safely
-        file_bytes = uploaded_file.getvalue()
-        
         with st.spinner("Processing..."):
-            upload_to_cloudinary(file_bytes, uploaded_file.name)
+            file_digest = hashlib.blake2b(file_bytes, digest_size=16).digest()
+            
+            # 1. Backup upload runs in the background while the PDF is processed
+            #    (skipped if this file was already backed up in this session).
+            #    Values are the backup URL, or the Future of an upload in flight.
+            uploaded_urls = st.session_state.setdefault("uploaded", {})
+            upload_key = (uploaded_file.name, file_digest)
+            upload_future = uploaded_urls.get(upload_key)
+            upload_wait = 0  # an upload from an earlier click is only polled
+            if upload_future is None:
+                upload_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                upload_future = upload_pool.submit(
+                    upload_to_cloudinary, file_bytes, uploaded_file.name, file_digest.hex()
+                )
+                upload_pool.shutdown(wait=False)
+                uploaded_urls[upload_key] = upload_future
+                upload_wait = 30
             
             try:
-                # 2. PDF Processing
-                modified_doc = change_pdf_background(file_bytes, color_hex, intensity, is_overlay)
-                modified_pdf_bytes = modified_doc.tobytes()
-                modified_doc.close()
+                # 2. PDF Processing (reuse the last result if nothing changed)
+                process_key = (file_digest, color_hex, intensity, is_overlay)
+                new_name = f"colored_{uploaded_file.name}"
+                download_slot = st.empty()
+                
+                if st.session_state.get("last_key") == process_key:
+                    modified_pdf_bytes = st.session_state["last_bytes"]
+                else:
+                    if count_pages(file_bytes) > QUICK_COPY_MIN_PAGES:
+                        try:
+                            modified_pdf_bytes = change_pdf_background(
+                                file_bytes, rgb_color, intensity, is_overlay, _lookup_only=True
+                            )
+                        except _CacheMiss:
+                            # Very long PDF: offer the first pages right away, then
+                            # swap in the full version once the rest is done
+                            def offer_first_pages(quick_pdf_bytes):
+                                download_slot.download_button(
+                                    label=f"📥 Download Now (first {QUICK_PAGES} pages only)",
+                                    data=quick_pdf_bytes,
+                                    file_name=f"first_{QUICK_PAGES}_pages_{new_name}",
+                                    mime="application/pdf",
+                                    on_click="ignore"
+                                )
+                            modified_pdf_bytes = color_pdf(
+                                file_bytes, rgb_color, intensity, is_overlay, on_first_pages=offer_first_pages
+                            )
+                            change_pdf_background(
+                                file_bytes, rgb_color, intensity, is_overlay, _result=modified_pdf_bytes
+                            )
+                    else:
+                        modified_pdf_bytes = change_pdf_background(file_bytes, rgb_color, intensity, is_overlay)
+                    st.session_state["last_key"] = process_key
+                    st.session_state["last_bytes"] = modified_pdf_bytes
+                
+                # 3. Wait for the backup (processing succeeds either way)
+                if isinstance(upload_future, concurrent.futures.Future):
+                    try:
+                        file_url = upload_future.result(timeout=upload_wait)
+                    except concurrent.futures.TimeoutError:
+                        pass  # still uploading; stays recorded so it isn't resubmitted
+                    except Exception as e:
+                        # Backup crashed: never let that block the download
+                        print(f"Backup Error: {e}")
+                        del uploaded_urls[upload_key]
+                    else:
+                        if file_url:
+                            uploaded_urls[upload_key] = file_url
+                            st.toast("☁️ Backup saved to the cloud")
+                        else:
+                            # Backup failed: let the next click try again
+                            del uploaded_urls[upload_key]
                 
                 st.balloons()
                 st.success("Processing Complete!")
                 
-                new_name = f"colored_{uploaded_file.name}"
-                
-                st.download_button(
+                download_slot.download_button(
                     label="📥 Download Modified PDF",
                     data=modified_pdf_bytes,
                     file_name=new_name,
@@ -132,29 +407,10 @@ with col1:
 with col2:
     if uploaded_file is not None:
         st.subheader("2. Preview")
-        file_bytes = uploaded_file.getvalue()
         
         try:
-            preview_doc = fitz.open(stream=file_bytes, filetype="pdf")
-            first_page = preview_doc[0]
-            
-            # Apply effect
-            rect = first_page.rect
-            shape = first_page.new_shape()
-            rgb_color = hex_to_rgb(color_hex)
-            
-            if is_overlay:
-                shape.draw_rect(rect)
-                shape.finish(fill=rgb_color, fill_opacity=intensity, color=None)
-                shape.commit(overlay=True)
-            else:
-                shape.draw_rect(rect)
-                shape.finish(fill=rgb_color, color=rgb_color)
-                shape.commit(overlay=False)
-            
-            pix = first_page.get_pixmap(dpi=100)
-            st.image(pix.tobytes(), caption="Preview of Page 1", use_container_width=True)
-            preview_doc.close()
+            preview_img = render_preview_image(file_bytes, rgb_color, intensity, is_overlay)
+            st.image(preview_img, caption="Preview of Page 1", use_container_width=True)
             
         except Exception as e:
             st.error(f"Preview Error: {e}")
\ No newline at end of file